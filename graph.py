@@ -1,4 +1,6 @@
 import matplotlib.pyplot as plt
+import numpy as np
+import os
 import time
 
 # Constants
@@ -6,23 +8,36 @@ BOLTZMANN_CONSTANT = 1.380649e-23  # J/K
 mass = 4.65e-26 # kg (mass of Nitrogen)
 
 
-def read_speeds_from_file(filename):
-    with open(filename, "r") as file:
-        return [float(line.strip()) for line in file if line.strip()]
+def map_speeds(filename):
+    # None until particle_sim.py has created the file
+    try:
+        return np.memmap(filename, dtype=np.float64, mode="r")
+    except (FileNotFoundError, ValueError):
+        return None
 
 def live_plot_histogram(filename, interval=1, mass=mass):
     plt.ion()  # Turn on interactive mode
     fig, ax = plt.subplots(figsize=(10, 6))
 
+    # Mapped once; the simulation's writes show up through the shared page cache.
+    # The map is only reopened when the file appears or changes size, e.g. when
+    # particle_sim.py is restarted with a different particle count
+    speeds = map_speeds(filename)
+
     while True:
         ax.clear()
-        speeds = read_speeds_from_file(filename)
+        try:
+            file_size = os.path.getsize(filename)
+        except OSError:
+            file_size = 0
+        if speeds is None or speeds.nbytes != file_size:
+            speeds = map_speeds(filename)
 
-        if not speeds:
+        if speeds is None:
             ax.set_title("No data available")
         else:
-            average_speed = sum(speeds) / len(speeds)
-            average_ke = sum(0.5 * mass * v**2 for v in speeds) / len(speeds)
+            average_speed = speeds.mean()
+            average_ke = 0.5 * mass * (speeds**2).mean()
 
             # Convert KE to temperature
             temperature = (2 / 3) * (average_ke / BOLTZMANN_CONSTANT)
@@ -51,4 +66,4 @@ def live_plot_histogram(filename, interval=1, mass=mass):
         time.sleep(interval)
 
 if __name__ == "__main__":
-    live_plot_histogram("speeds.csv", interval=1)
+    live_plot_histogram("speeds.bin", interval=1)
@@ -1,6 +1,10 @@
 import pygame
 import math
-import random
+import numpy as np
+import queue
+from numba import njit, prange
+import multiprocessing
+from multiprocessing import shared_memory
 import threading
 import time
 
@@ -10,140 +14,213 @@ SCREEN_HEIGHT = 900
 NUM_PARTICLES = 5000
 SIMULATION_RATE = 100  # Hz
 RENDER_RATE = 60       # FPS
-GRID_SIZE = 10         # Grid cell size in pixels
+RADIUS = 1             # Particle radius in pixels
 k_B = 1.380649e-23     # Boltzmann constant in J/K
 mass = 4.65e-26        # Mass of nitrogen molecule (N2) in kg
 Target_Temp = 300      # Kelvin
 
-class Particle:
-    def __init__(self, mass, x, y, velocity_x, velocity_y, radius):
-        self.m = mass
-        self.x = x
-        self.y = y
-        self.v_x = velocity_x
-        self.v_y = velocity_y
-        self.r = radius
-
-    def move(self, dt):
-        self.x += self.v_x * dt
-        self.y += self.v_y * dt
-
-        wall_bounce = 0
-
-        # Bounce off walls
-        if self.x - self.r < 0 or self.x + self.r > SCREEN_WIDTH:
-            self.v_x *= -1
-            self.x = max(self.r, min(SCREEN_WIDTH - self.r, self.x))
-            wall_bounce += 1
-        if self.y - self.r < 0 or self.y + self.r > SCREEN_HEIGHT:
-            self.v_y *= -1
-            self.y = max(self.r, min(SCREEN_HEIGHT - self.r, self.y))
-            wall_bounce += 1
-
-        return wall_bounce
-
-    def draw(self, screen, color=(255, 0, 0)):
-        pygame.draw.circle(screen, color, (int(self.x), int(self.y)), self.r)
-
-    def check_collision(self, other):
-        dx = other.x - self.x
-        dy = other.y - self.y
-        dist = math.hypot(dx, dy)
-        return dist < self.r + other.r
-
-    def resolve_collision(self, other):
-        dx = other.x - self.x
-        dy = other.y - self.y
-        dist = math.hypot(dx, dy)
-        if dist == 0:
-            return  # prevent division by zero
-
-        # Normal vector
-        nx = dx / dist
-        ny = dy / dist
-
-        # Relative velocity
-        dvx = self.v_x - other.v_x
-        dvy = self.v_y - other.v_y
-
-        # Dot product of relative velocity and normal
-        dot = dvx * nx + dvy * ny
-
-        if dot > 0:
-            return  # Already moving away
-
-        restitution = 1.0  # perfectly elastic
-
-        impulse = (-(1 + restitution) * dot) / (1 / self.m + 1 / other.m)
-        impulse_x = impulse * nx
-        impulse_y = impulse * ny
-
-        self.v_x += impulse_x / self.m
-        self.v_y += impulse_y / self.m
-        other.v_x -= impulse_x / other.m
-        other.v_y -= impulse_y / other.m
-
-        # Optional: resolve overlap
-        overlap = 0.5 * (self.r + other.r - dist + 1)
-        self.x -= nx * overlap
-        self.y -= ny * overlap
-        other.x += nx * overlap
-        other.y += ny * overlap
-
-
-# Shared particle list and lock
-particles = []
-lock = threading.Lock()
-bounces = 0
-
-def get_cell(x, y):
-    return int(x // GRID_SIZE), int(y // GRID_SIZE)
-
-def simulate():
-    global bounces
+# Shared particle state, stored as a struct of arrays indexed by particle. Each array
+# lives in its own shared memory block so the simulation process and the renderer
+# work on the same data; xy holds two position buffers, one of which the renderer
+# draws while the simulation fills the other
+STATE_LAYOUT = {
+    "x": ((NUM_PARTICLES,), np.float64),
+    "y": ((NUM_PARTICLES,), np.float64),
+    "vx": ((NUM_PARTICLES,), np.float64),
+    "vy": ((NUM_PARTICLES,), np.float64),
+    "m": ((NUM_PARTICLES,), np.float32),
+    "r": ((NUM_PARTICLES,), np.float32),
+    "xy": ((2, NUM_PARTICLES, 2), np.float64),
+}
+
+# Grid cells are one particle diameter wide, so touching particles always share a cell
+# or sit in neighboring cells
+r_max = float(RADIUS)
+GRID_SIZE = 2 * r_max  # Grid cell size in pixels
+GRID_COLS = int(SCREEN_WIDTH // GRID_SIZE)
+GRID_ROWS = int(SCREEN_HEIGHT // GRID_SIZE)
+
+# Cell ids are flat indices into the grid plus a ring of always-empty cells around it,
+# so a neighbor is a fixed offset from its cell and never needs a bounds check
+GRID_STRIDE = GRID_COLS + 2
+NUM_CELLS = GRID_STRIDE * (GRID_ROWS + 2)
+HALF_SHELL = (1 - GRID_STRIDE, 1, 1 + GRID_STRIDE, GRID_STRIDE)  # Neighbor cells paired with each cell
+SCAN_BLOCK = 4096  # Cells per block in the parallel prefix sum over the grid
+
+def create_state():
+    blocks = {}
+    for key, (shape, dtype) in STATE_LAYOUT.items():
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        blocks[key] = shared_memory.SharedMemory(create=True, size=size)
+    return blocks
+
+def state_arrays(blocks):
+    return [
+        np.ndarray(shape, dtype=dtype, buffer=blocks[key].buf)
+        for key, (shape, dtype) in STATE_LAYOUT.items()
+    ]
+
+@njit(parallel=True, nogil=True, boundscheck=False, cache=True)
+def build_cells(x, y, cells, counts, cell_start, block_start, particle_idx):
+    # Counting sort of particle indices by cell id into the CSR-style cell list:
+    # the particles in cell c are particle_idx[cell_start[c]:cell_start[c + 1]]
+    for c in prange(counts.size):
+        counts[c] = 0
+    for i in prange(x.size):
+        col = min(max(int(x[i] // GRID_SIZE), 0), GRID_COLS - 1)
+        row = min(max(int(y[i] // GRID_SIZE), 0), GRID_ROWS - 1)
+        cells[i] = (col + 1) + (row + 1) * GRID_STRIDE
+
+    # There are far fewer particles than cells, so the histogram itself stays serial
+    for i in range(x.size):
+        counts[cells[i]] += 1
+
+    # Blocked prefix sum over the cells: total each block in parallel, scan the few
+    # block totals, then fill in the offsets within each block in parallel. counts
+    # is reused as the write cursor of each cell
+    num_blocks = block_start.size - 1
+    block_start[0] = 0
+    for b in prange(num_blocks):
+        block_start[b + 1] = counts[b * SCAN_BLOCK:(b + 1) * SCAN_BLOCK].sum()
+    for b in range(num_blocks):
+        block_start[b + 1] += block_start[b]
+    for b in prange(num_blocks):
+        offset = block_start[b]
+        for c in range(b * SCAN_BLOCK, min((b + 1) * SCAN_BLOCK, counts.size)):
+            cell_start[c] = offset
+            offset += counts[c]
+            counts[c] = cell_start[c]
+    cell_start[counts.size] = block_start[num_blocks]
+
+    for i in range(x.size):
+        c = cells[i]
+        particle_idx[counts[c]] = i
+        counts[c] += 1
+
+@njit(nogil=True, fastmath=True, boundscheck=False, cache=True)
+def resolve_collision(a, b, x, y, vx, vy, r):
+    dx = x[b] - x[a]
+    dy = y[b] - y[a]
+    dist2 = dx * dx + dy * dy
+    r_sum = r[a] + r[b]
+    if dist2 >= r_sum * r_sum or dist2 == 0:
+        return  # not touching, or coincident (prevent division by zero)
+
+    # Normal vector
+    dist = np.sqrt(dist2)
+    nx = dx / dist
+    ny = dy / dist
+
+    # Dot product of relative velocity and normal
+    dot = (vx[a] - vx[b]) * nx + (vy[a] - vy[b]) * ny
+    if dot > 0:
+        return  # Already moving away
+
+    # Every particle has the same mass, so the perfectly elastic impulse
+    # -(1 + 1) * dot / (2 / m) divided by m is just -dot along the normal
+    vx[a] -= dot * nx
+    vy[a] -= dot * ny
+    vx[b] += dot * nx
+    vy[b] += dot * ny
+
+    # Optional: resolve overlap
+    overlap = 0.5 * (r_sum - dist + 1)
+    x[a] -= nx * overlap
+    y[a] -= ny * overlap
+    x[b] += nx * overlap
+    y[b] += ny * overlap
+
+@njit(parallel=True, nogil=True, fastmath=True, boundscheck=False, cache=True)
+def collide(x, y, vx, vy, r, cell_start, particle_idx):
+    # Cells are swept in 9 interleaved passes; cells handled in the same pass are
+    # 3 apart, so their neighborhoods never overlap and threads never share a particle
+    for sweep in range(9):
+        off_x = sweep % 3
+        off_y = sweep // 3
+        cols = (GRID_COLS - off_x + 2) // 3
+        rows = (GRID_ROWS - off_y + 2) // 3
+        for k in prange(cols * rows):
+            cx = off_x + 3 * (k % cols)
+            cy = off_y + 3 * (k // cols)
+            c = (cx + 1) + (cy + 1) * GRID_STRIDE
+            for ia in range(cell_start[c], cell_start[c + 1]):
+                a = particle_idx[ia]
+
+                # Pairs within the cell
+                for ib in range(ia + 1, cell_start[c + 1]):
+                    resolve_collision(a, particle_idx[ib], x, y, vx, vy, r)
+
+                # Pairs with the forward half of the neighborhood; the other half
+                # is covered when those cells pair back with this one
+                for offset in HALF_SHELL:
+                    nc = c + offset
+                    for ib in range(cell_start[nc], cell_start[nc + 1]):
+                        resolve_collision(a, particle_idx[ib], x, y, vx, vy, r)
+
+def make_step(width, height, dt):
+    # The box size and time step are the only values closed over, so Numba compiles
+    # them in as constants and its cache is reused until one of them changes
+    @njit(nogil=True, fastmath=True, boundscheck=False, cache=True)
+    def step(x, y, vx, vy, m, r, cells, counts, cell_start, block_start, particle_idx):
+        # One full physics step, run without the GIL
+        momentum = 0.0
+        wall_bounces = 0
+        for i in range(x.size):
+            x[i] += vx[i] * dt
+            y[i] += vy[i] * dt
+
+            # Bounce off walls, transferring 2*m*|v| of momentum on each hit
+            if x[i] - r[i] < 0 or x[i] + r[i] > width:
+                momentum += 2 * m[i] * abs(vx[i])
+                vx[i] = -vx[i]
+                x[i] = max(r[i], min(width - r[i], x[i]))
+                wall_bounces += 1
+            if y[i] - r[i] < 0 or y[i] + r[i] > height:
+                momentum += 2 * m[i] * abs(vy[i])
+                vy[i] = -vy[i]
+                y[i] = max(r[i], min(height - r[i], y[i]))
+                wall_bounces += 1
+
+        # Spatial grid for particle collisions
+        build_cells(x, y, cells, counts, cell_start, block_start, particle_idx)
+        collide(x, y, vx, vy, r, cell_start, particle_idx)
+
+        return momentum, wall_bounces
+
+    return step
+
+def simulate(blocks, front):
+    # Runs in its own process; front is the index of the xy buffer the renderer draws
+    x, y, vx, vy, m, r, xy = state_arrays(blocks)
+
+    # Cell list, rebuilt in place every step
+    cells = np.empty(NUM_PARTICLES, dtype=np.int32)
+    counts = np.zeros(NUM_CELLS, dtype=np.int32)
+    cell_start = np.zeros(NUM_CELLS + 1, dtype=np.int32)
+    block_start = np.zeros((NUM_CELLS + SCAN_BLOCK - 1) // SCAN_BLOCK + 1, dtype=np.int32)
+    particle_idx = np.empty(NUM_PARTICLES, dtype=np.int32)
+
+    stats_queue = queue.Queue()
+    stats_thread = threading.Thread(target=print_stats, args=(stats_queue,), daemon=True)
+    stats_thread.start()
+
     dt = 1.0 / SIMULATION_RATE
+    step = make_step(SCREEN_WIDTH, SCREEN_HEIGHT, dt)
     perimeter = 2 * (SCREEN_WIDTH + SCREEN_HEIGHT)  # meters, since 1 pixel = 1 meter
 
     t = 0
+    bounces = 0
     total_momentum_transfer = 0.0  # kg·m/s
 
     while True:
-        with lock:
-            for p in particles:
-                # Before move: store velocity for momentum transfer calc
-                old_vx, old_vy = p.v_x, p.v_y
-                wall_bounce = p.move(dt)
-
-                # Calculate momentum transfer only if wall collision occurred
-                if wall_bounce:
-                    if p.x - p.r <= 0 or p.x + p.r >= SCREEN_WIDTH:
-                        total_momentum_transfer += 2 * p.m * abs(old_vx)
-                    if p.y - p.r <= 0 or p.y + p.r >= SCREEN_HEIGHT:
-                        total_momentum_transfer += 2 * p.m * abs(old_vy)
-
-                bounces += wall_bounce
-
-            # Spatial grid for particle collisions
-            grid = {}
-            for p in particles:
-                cell = get_cell(p.x, p.y)
-                grid.setdefault(cell, []).append(p)
-
-            visited = set()
-            for cell, cell_particles in grid.items():
-                neighbors = [
-                    (cell[0] + dx, cell[1] + dy)
-                    for dx in (-1, 0, 1)
-                    for dy in (-1, 0, 1)
-                ]
-                for a in cell_particles:
-                    for neighbor in neighbors:
-                        for b in grid.get(neighbor, []):
-                            if a is b or (id(a), id(b)) in visited or (id(b), id(a)) in visited:
-                                continue
-                            if a.check_collision(b):
-                                a.resolve_collision(b)
-                            visited.add((id(a), id(b)))
+        momentum, wall_bounces = step(x, y, vx, vy, m, r, cells, counts, cell_start, block_start, particle_idx)
+        back = 1 - front.value
+        xy[back, :, 0] = x
+        xy[back, :, 1] = y
+        with front.get_lock():
+            front.value = back
+        total_momentum_transfer += momentum
+        bounces += wall_bounces
 
         # Once per second
         t += 1
@@ -151,9 +228,9 @@ def simulate():
             pressure = total_momentum_transfer / perimeter  # in Pascals (N/m)
             k_B = 1.38e-23
             Target_Temp = 300  # Kelvin
-            ideal_pressure = (len(particles) * k_B * Target_Temp) / (900**2)
+            ideal_pressure = (NUM_PARTICLES * k_B * Target_Temp) / (900**2)
             percent_diff = 100 * abs(pressure - ideal_pressure) / ideal_pressure
-            print(f"Bounces/sec: {bounces}, Actual Pressure: {pressure:.3e} Pa,  Ideal Pressure: {ideal_pressure:.3e}, Percent Diff: {percent_diff:.3}%")
+            stats_queue.put((bounces, pressure, ideal_pressure, percent_diff))
             bounces = 0
             total_momentum_transfer = 0.0
 
@@ -162,60 +239,91 @@ def simulate():
 
         time.sleep(dt)
 
-def get_speeds():
+def print_stats(stats_queue):
+    # Terminal output happens here so a slow stdout never stalls the simulation
     while True:
-        with open("speeds.csv", "w") as file:
-            for p in particles:
-                speed = math.sqrt(p.v_x ** 2 + p.v_y ** 2)
-                file.write(f"{speed}\n")
-        time.sleep(1.5)
+        bounces, pressure, ideal_pressure, percent_diff = stats_queue.get()
+        print(f"Bounces/sec: {bounces}, Actual Pressure: {pressure:.3e} Pa,  Ideal Pressure: {ideal_pressure:.3e}, Percent Diff: {percent_diff:.3}%")
+
+def get_speeds(vx, vy, stop):
+    # Speeds are shared with graph.py through a binary memory-mapped file
+    speeds = np.memmap("speeds.bin", dtype=np.float64, mode="w+", shape=(NUM_PARTICLES,))
+    while not stop.is_set():
+        np.sqrt(vx * vx + vy * vy, out=speeds)
+        speeds.flush()
+        stop.wait(1.5)
 
 def main():
     v_rms = math.sqrt((2 * k_B * Target_Temp) / mass)
-    global particles
-
-    pygame.init()
-    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
-    pygame.display.set_caption("Optimized Elastic Particle Collision Simulation")
-    clock = pygame.time.Clock()
-
-    # Initialize particles
-    for _ in range(NUM_PARTICLES):
-        while True:
-            angle = random.uniform(0, 2 * math.pi)
-            v_x = v_rms * math.cos(angle)
-            v_y = v_rms * math.sin(angle)
-            x = random.uniform(10, SCREEN_WIDTH - 10)
-            y = random.uniform(10, SCREEN_HEIGHT - 10)
-            radius = 1
-            p = Particle(mass, x, y, v_x, v_y, radius)
-
-            if all(not p.check_collision(other) for other in particles):
-                particles.append(p)
-                break
-
-    # Start simulation thread
-    sim_thread = threading.Thread(target=simulate, daemon=True)
-    sim_thread.start()
-
-    speeds_thread = threading.Thread(target=get_speeds, daemon=True)
+    blocks = create_state()
+    x, y, vx, vy, m, r, xy = state_arrays(blocks)
+    front = multiprocessing.Value("i", 0)
+
+    # Initialize particles on random points of a lattice, spaced so that even with
+    # the jitter no two particles start out touching
+    rng = np.random.default_rng()
+    spacing = int(2 * r_max) + 1
+    lattice_x = np.arange(10, SCREEN_WIDTH - 10, spacing)
+    lattice_y = np.arange(10, SCREEN_HEIGHT - 10, spacing)
+    points = rng.choice(lattice_x.size * lattice_y.size, NUM_PARTICLES, replace=False)
+    x[:] = lattice_x[points % lattice_x.size] + rng.uniform(-0.5, 0.5, NUM_PARTICLES)
+    y[:] = lattice_y[points // lattice_x.size] + rng.uniform(-0.5, 0.5, NUM_PARTICLES)
+
+    angles = rng.uniform(0, 2 * np.pi, NUM_PARTICLES)
+    vx[:] = v_rms * np.cos(angles)
+    vy[:] = v_rms * np.sin(angles)
+    m[:] = mass
+    r[:] = RADIUS
+    xy[0, :, 0] = x
+    xy[0, :, 1] = y
+
+    # Start simulation process before pygame sets up its signal handlers, which the
+    # child would otherwise inherit
+    sim_process = multiprocessing.Process(target=simulate, args=(blocks, front), daemon=True)
+    sim_process.start()
+
+    speeds_stop = threading.Event()
+    speeds_thread = threading.Thread(target=get_speeds, args=(vx, vy, speeds_stop), daemon=True)
     speeds_thread.start()
 
-    running = True
-    while running:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
-
-        screen.fill((255, 255, 255))
-        with lock:
-            for p in particles:
-                p.draw(screen, (0, 100, 255))
-
-        pygame.display.flip()
-        clock.tick(RENDER_RATE)
-
-    pygame.quit()
+    try:
+        pygame.init()
+        screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+        pygame.display.set_caption("Optimized Elastic Particle Collision Simulation")
+        clock = pygame.time.Clock()
+
+        # All particles share one radius, so draw the circle once and blit copies of it
+        radius = int(r_max)
+        sprite = pygame.Surface((2 * radius + 1, 2 * radius + 1), pygame.SRCALPHA)
+        pygame.draw.circle(sprite, (0, 100, 255), (radius, radius), radius)
+
+        running = True
+        while running:
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    running = False
+
+            screen.fill((255, 255, 255))
+            with front.get_lock():
+                positions = xy[front.value].astype(int)
+            screen.blits([(sprite, (px - radius, py - radius)) for px, py in positions.tolist()], doreturn=False)
+
+            pygame.display.flip()
+            clock.tick(RENDER_RATE)
+    finally:
+        # Runs on any exit, including an exception or Ctrl+C, so the simulation
+        # process and the shared memory blocks never outlive the window
+        sim_process.terminate()
+        sim_process.join()
+        speeds_stop.set()
+        speeds_thread.join()
+
+        # A block can only be closed once no array views into it are left
+        del x, y, vx, vy, m, r, xy
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+        pygame.quit()
 
 if __name__ == "__main__":
     main()